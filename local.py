@@ -1,58 +1,158 @@
 import os
+import hashlib
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import imageio
+import tifffile
 import matplotlib.pyplot as plt
 from matplotlib import gridspec, ticker
 import numpy as np
-from PIL import Image
 import torch
-from torch.utils.data import Dataset
-from torchvision import transforms
+from torch.utils.data import DataLoader, Dataset
+from torchvision import tv_tensors
+import torchvision.transforms.v2 as transforms_v2
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from skimage.segmentation import relabel_sequential
 from scipy.optimize import linear_sum_assignment
 
+try:
+    import numba
+except ImportError:  # fall back to the vectorized numpy implementation
+    numba = None
+
 
 def show_one_image(image_path):
     image = imageio.imread(image_path)
     plt.imshow(image)
 
 
+def _stack_if_uniform(tensors):
+    if len(tensors) > 0 and all(t.shape == tensors[0].shape for t in tensors):
+        return torch.stack(tensors)
+    return tensors
+
+
 class NucleiDataset(Dataset):
     """A PyTorch dataset to load cell images and nuclei masks"""
 
-    def __init__(self, root_dir, transform=None, img_transform=None):
+    # description of the input preprocessing done in _image_to_tensor, part of the
+    # cache key
+    preprocessing = "grayscale, normalize(mean=0.5, std=0.5), float32 masks"
+
+    def __init__(
+        self, root_dir, transform=None, img_transform=None, cache=True, lazy=False
+    ):
         self.root_dir = root_dir  # the directory with all the training samples
-        self.samples = os.listdir(self.root_dir)  # list the samples
+        # list the samples, skipping any cache files stored alongside them
+        self.samples = sorted(
+            s
+            for s in os.listdir(self.root_dir)
+            if os.path.isdir(os.path.join(self.root_dir, s))
+        )
         self.transform = (
             transform  # transformations to apply to both inputs and targets
         )
 
         self.img_transform = img_transform  # transformations to apply to raw image only
-        #  transformations to apply just to inputs
-        inp_transforms = transforms.Compose(
-            [
-                transforms.Grayscale(),
-                transforms.ToTensor(),
-                transforms.Normalize([0.5], [0.5]),  # 0.5 = mean and 0.5 = variance
-            ]
-        )
 
-        self.loaded_imgs = [None] * len(self.samples)
-        self.loaded_masks = [None] * len(self.samples)
-        for sample_ind in range(len(self.samples)):
-            img_path = os.path.join(
-                self.root_dir, self.samples[sample_ind], "image.tif"
-            )
-            image = Image.open(img_path)
-            image.load()
-            self.loaded_imgs[sample_ind] = inp_transforms(image)
-            mask_path = os.path.join(
-                self.root_dir, self.samples[sample_ind], "mask.tif"
+        # with lazy=True the tifs are only memory-mapped and converted to tensors
+        # in __getitem__, for datasets that do not fit in memory. Nothing is
+        # opened here, so no file descriptors are held between samples
+        self.lazy = lazy
+        if self.lazy:
+            self.loaded_imgs = None
+            self.loaded_masks = None
+            return
+
+        # the decoded tensors are cached next to the samples, keyed on the
+        # sample list, the size and modification time of every file and the
+        # input preprocessing so stale caches are never reused
+        file_stats = []
+        for sample in self.samples:
+            for filename in ("image.tif", "mask.tif"):
+                stat = os.stat(os.path.join(self.root_dir, sample, filename))
+                file_stats.append((stat.st_size, stat.st_mtime_ns))
+        cache_key = hashlib.sha1(
+            repr((self.samples, file_stats, self.preprocessing)).encode()
+        ).hexdigest()[:16]
+        cache_path = os.path.join(self.root_dir, f".cache_{cache_key}.pt")
+        if cache and os.path.exists(cache_path):
+            cached = torch.load(
+                cache_path, map_location="cpu", mmap=True, weights_only=True
             )
-            mask = Image.open(mask_path)
-            mask.load()
-            self.loaded_masks[sample_ind] = transforms.ToTensor()(mask)
+            self.loaded_imgs = cached["imgs"]
+            self.loaded_masks = cached["masks"]
+            return
+
+        # decoding releases the GIL, so load the samples on a thread pool
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            loaded = list(executor.map(self._load_one, range(len(self.samples))))
+        # keep the samples in one contiguous tensor each when their shapes
+        # allow it, indexing then returns views into a single buffer
+        self.loaded_imgs = _stack_if_uniform([image for image, _ in loaded])
+        self.loaded_masks = _stack_if_uniform([mask for _, mask in loaded])
+
+        if cache:
+            # write to a unique temporary file first, so concurrent builders
+            # never overwrite each other's partial cache
+            tmp_path = None
+            try:
+                fd, tmp_path = tempfile.mkstemp(
+                    prefix=".cache_", suffix=".pt.tmp", dir=self.root_dir
+                )
+                os.close(fd)
+                torch.save(
+                    {"imgs": self.loaded_imgs, "masks": self.loaded_masks}, tmp_path
+                )
+                # mkstemp creates the file readable by its owner only
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, cache_path)
+            except (OSError, RuntimeError):
+                # e.g. a read-only data directory or a full disk, torch.save
+                # reports these as RuntimeError. Just skip caching
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    # read the raw array of a tif file, memory-mapped if it is uncompressed
+    def _read(self, sample_ind, filename, mmap=False):
+        path = os.path.join(self.root_dir, self.samples[sample_ind], filename)
+        if mmap:
+            try:
+                return tifffile.memmap(path, mode="r")
+            except ValueError:
+                # compressed tifs can not be memory-mapped, decode them instead
+                pass
+        return imageio.imread(path)
+
+    @staticmethod
+    def _image_to_tensor(image):
+        if image.ndim == 3:
+            # same luma weights as PIL's grayscale conversion, alpha is dropped
+            image = image[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        else:
+            image = image.astype(np.float32)
+        # scale to [0, 1], then normalize with mean 0.5 and std 0.5 in one step
+        image *= 1.0 / 127.5
+        image -= 1.0
+        return torch.from_numpy(image).unsqueeze(0)
+
+    @staticmethod
+    def _mask_to_tensor(mask):
+        # masks are stored as float32 so train can use them as targets directly
+        if mask.dtype == np.uint8:
+            mask = mask.astype(np.float32) / 255.0
+        else:
+            mask = mask.astype(np.float32)
+        return torch.from_numpy(mask).unsqueeze(0)
+
+    # load and preprocess a single image and mask pair
+    def _load_one(self, sample_ind):
+        image = self._image_to_tensor(self._read(sample_ind, "image.tif"))
+        mask = self._mask_to_tensor(self._read(sample_ind, "mask.tif"))
+        return image, mask
 
     # get the total number of samples
     def __len__(self):
@@ -60,18 +160,31 @@ class NucleiDataset(Dataset):
 
     # fetch the training sample given its index
     def __getitem__(self, idx):
-        # we'll be using Pillow library for reading files
-        # since many torchvision transforms operate on PIL images
-        image = self.loaded_imgs[idx]
-        mask = self.loaded_masks[idx]
+        # images and masks are already decoded into tensors in __init__,
+        # unless they are read lazily from (memory-mapped) files
+        if self.lazy:
+            image = self._image_to_tensor(self._read(idx, "image.tif", mmap=True))
+            mask = self._mask_to_tensor(self._read(idx, "mask.tif", mmap=True))
+        else:
+            image = self.loaded_imgs[idx]
+            mask = self.loaded_masks[idx]
         if self.transform is not None:
-            # Note: using seeds to ensure the same random transform is applied to
-            # the image and mask
-            seed = torch.seed()
-            torch.manual_seed(seed)
-            image = self.transform(image)
-            torch.manual_seed(seed)
-            mask = self.transform(mask)
+            if isinstance(self.transform, transforms_v2.Transform):
+                # v2 transforms draw one set of random parameters per call and
+                # apply them to every input, so the image and mask stay aligned
+                image, mask = self.transform(
+                    tv_tensors.Image(image), tv_tensors.Mask(mask)
+                )
+                image = image.as_subclass(torch.Tensor)
+                mask = mask.as_subclass(torch.Tensor)
+            else:
+                # Note: using seeds to ensure the same random transform is applied
+                # to the image and mask
+                seed = torch.seed()
+                torch.manual_seed(seed)
+                image = self.transform(image)
+                torch.manual_seed(seed)
+                mask = self.transform(mask)
         if self.img_transform is not None:
             image = self.img_transform(image)
         return image, mask
@@ -94,8 +207,12 @@ def show_random_dataset_image_with_prediction(dataset, model, device="cpu"):
     idx = np.random.randint(0, len(dataset))  # take a random sample
     img, mask = dataset[idx]  # get the image and the nuclei masks
     x = img.to(device).unsqueeze(0)
-    y = model(x)[0].detach().cpu().numpy()
-    print("MSE loss:", np.mean((mask[0].numpy() - y[0]) ** 2))
+    with torch.no_grad():
+        prediction = model(x)[0]
+        # compute the loss on the device, only the scalar is copied back
+        mse = torch.mean((mask[0].to(device) - prediction[0]) ** 2).item()
+    y = prediction.cpu().numpy()
+    print("MSE loss:", mse)
     f, axarr = plt.subplots(1, 3)  # make two plots on one figure
     axarr[0].imshow(img[0])  # show the image
     axarr[0].set_title("Image")
@@ -178,6 +295,49 @@ def apply_and_show_random_image(f, ds):
         #     ax.spines[spine].set_visible(False)
 
 
+# gradient scalers for fp16 training in train, one per optimizer
+_grad_scalers = weakref.WeakKeyDictionary()
+
+# torch.compile wrappers of the models trained with compile=True, kept outside
+# the models themselves so they can still be deep-copied
+_compiled_models = weakref.WeakKeyDictionary()
+
+
+def _log_images(tb_logger, images, step):
+    for tag, img_tensor in images.items():
+        tb_logger.add_images(tag=tag, img_tensor=img_tensor, global_step=step)
+
+
+def gpu_augment(*tensors, generator=None):
+    """
+    Apply the same random flips and 90 degree rotations to a batch of tensors.
+
+    Every sample in the batch gets its own transform, but it is shared by all
+    tensors passed in, and everything runs as batched tensor ops on the device
+    the tensors are on.
+
+    Only use this for targets that do not depend on direction, such as masks
+    and signed distance transforms. Flipping or rotating affinities (and
+    their weights) would move each edge by its offset and mix up the
+    horizontal and vertical channels.
+    """
+    x = tensors[0]
+    n = x.shape[0]
+    flags = torch.rand(3, n, device=x.device, generator=generator) < 0.5
+    # rotating non-square images would change their shape
+    square = x.shape[-1] == x.shape[-2]
+
+    augmented = []
+    for t in tensors:
+        view = (n,) + (1,) * (t.ndim - 1)
+        t = torch.where(flags[0].view(view), t.flip(-1), t)
+        t = torch.where(flags[1].view(view), t.flip(-2), t)
+        if square:
+            t = torch.where(flags[2].view(view), t.rot90(1, (-2, -1)), t)
+        augmented.append(t)
+    return tuple(augmented)
+
+
 def train(
     model,
     loader,
@@ -185,11 +345,33 @@ def train(
     loss_function,
     epoch,
     log_interval=100,
-    log_image_interval=20,
+    log_image_interval=200,
     tb_logger=None,
     device=None,
     early_stop=False,
+    compile=False,
+    use_amp=False,
+    augment_on_device=False,
 ):
+    """
+    Train the model for one epoch.
+
+    The targets (and weights) yielded by the loader must already have the
+    dtype of the model output, usually float32.
+
+    Batches are copied to the device with non_blocking=True, so build the
+    loader with pin_memory=True to let these copies overlap with compute,
+    e.g. with make_loader.
+    With compile=True the model is wrapped with torch.compile on the first
+    call and the compiled module is reused in later epochs.
+    With use_amp=True the forward pass on a cuda device runs under bf16
+    autocast, or fp16 with gradient scaling on gpus without bf16 support.
+    The loss is always computed in fp32.
+    With augment_on_device=True, random flips and rotations are applied to
+    each batch on the device with gpu_augment, instead of per sample in the
+    dataset workers. This is only valid for direction independent targets
+    such as masks and SDTs, not for affinities.
+    """
     if device is None:
         # You can pass in a device or we will default to using
         # the gpu. Feel free to try training on the cpu to see
@@ -203,162 +385,251 @@ def train(
     model.train()
 
     # move model to device
+    device = torch.device(device)
     model = model.to(device)
 
+    # compile the model once and reuse the compiled module in later epochs
+    if compile and hasattr(torch, "compile"):
+        if model not in _compiled_models:
+            _compiled_models[model] = torch.compile(model, mode="reduce-overhead")
+        model = _compiled_models[model]
+
+    # mixed precision is only used on the gpu
+    use_amp = use_amp and device.type == "cuda"
+    amp_dtype = torch.float32
+    scaler = None
+    if use_amp:
+        # bf16 is only native from Ampere on, older gpus merely emulate it
+        if torch.cuda.get_device_capability(device)[0] >= 8:
+            amp_dtype = torch.bfloat16
+        else:
+            # fp16 needs loss scaling, keep one scaler per optimizer so its
+            # scale carries over between epochs
+            amp_dtype = torch.float16
+            if optimizer not in _grad_scalers:
+                _grad_scalers[optimizer] = torch.amp.GradScaler("cuda")
+            scaler = _grad_scalers[optimizer]
+
+    # losses of the steps that have not been logged yet
+    window_losses = []
+
     # iterate over the batches of this epoch
     for batch_id, (x, y, *w) in enumerate(loader):
         # move input and target to the active device (either cpu or gpu)
         if len(w) > 0:
             w = w[0]
-            w = w.to(device)
+            w = w.to(device, non_blocking=True)
         else:
             w = None
-        x, y = x.to(device), y.to(device)
+        x = x.to(device, non_blocking=True)
+        y = y.to(device, non_blocking=True)
+        if augment_on_device:
+            if w is not None:
+                # weighted losses are used for affinities here, which
+                # gpu_augment can not flip or rotate correctly
+                raise ValueError(
+                    "augment_on_device only supports direction independent "
+                    "targets such as masks and SDTs, not weighted affinities"
+                )
+            x, y = gpu_augment(x, y)
 
         # zero the gradients for this iteration
         optimizer.zero_grad()
 
         # apply model and calculate loss
-        prediction = model(x)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+            prediction = model(x)
+        if use_amp:
+            prediction = prediction.float()
         assert prediction.shape == y.shape, (prediction.shape, y.shape)
-        if y.dtype != prediction.dtype:
-            y = y.type(prediction.dtype)
         loss = loss_function(prediction, y)
         if w is not None:
             weighted_loss = loss * w
             loss = torch.mean(weighted_loss)
 
         # backpropagate the loss and adjust the parameters
-        loss.backward()
-        optimizer.step()
-
-        # log to console
-        if batch_id % log_interval == 0:
-            print(
-                "Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}".format(
-                    epoch,
-                    batch_id * len(x),
-                    len(loader.dataset),
-                    100.0 * batch_id / len(loader),
-                    loss.item(),
-                )
-            )
-
-        # log to tensorboard
-        if tb_logger is not None:
-            step = epoch * len(loader) + batch_id
-            tb_logger.add_scalar(
-                tag="train_loss", scalar_value=loss.item(), global_step=step
-            )
-            # check if we log images in this iteration
-            if step % log_image_interval == 0:
-                tb_logger.add_images(
-                    tag="input", img_tensor=x.to("cpu"), global_step=step
-                )
-                tb_logger.add_images(
-                    tag="target", img_tensor=y.to("cpu"), global_step=step
-                )
-                tb_logger.add_images(
-                    tag="prediction",
-                    img_tensor=prediction.to("cpu").detach(),
-                    global_step=step,
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
+
+        # keep the loss on the device, it is only copied to the host (which
+        # waits for the device) once per log window
+        window_losses.append(loss.detach())
+        step = epoch * len(loader) + batch_id
+        stop = early_stop and batch_id > 5
+        if batch_id % log_interval == 0 or batch_id == len(loader) - 1 or stop:
+            losses = torch.stack(window_losses).tolist()
+            window_losses = []
+
+            # log to console
+            if batch_id % log_interval == 0:
+                print(
+                    "Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}".format(
+                        epoch,
+                        batch_id * len(x),
+                        len(loader.dataset),
+                        100.0 * batch_id / len(loader),
+                        losses[-1],
+                    )
                 )
 
-        if early_stop and batch_id > 5:
+            # log the loss of every step in the window to tensorboard
+            if tb_logger is not None:
+                first_step = step - len(losses) + 1
+                for i, value in enumerate(losses):
+                    tb_logger.add_scalar(
+                        tag="train_loss", scalar_value=value, global_step=first_step + i
+                    )
+
+        # log images to tensorboard, check if we log images in this iteration
+        if tb_logger is not None and step % log_image_interval == 0:
+            # only log the first sample of the batch, and encode the images
+            # in the background so the training loop is not blocked
+            images = {
+                "input": x[:1].detach().to("cpu"),
+                "target": y[:1].detach().to("cpu"),
+                "prediction": prediction[:1].detach().to("cpu"),
+            }
+            threading.Thread(target=_log_images, args=(tb_logger, images, step)).start()
+
+        if stop:
             print("Stopping test early!")
             break
 
 
-def compute_affinities(seg: np.ndarray, nhood: list):
-    nhood = np.array(nhood)
+def make_loader(dataset, batch_size, augment=False):
+    """
+    Build a shuffling DataLoader suited to the in-memory datasets used here.
 
+    Without augmentation __getitem__ only indexes preloaded tensors, so loading
+    in the main process is fastest. With augmentation, samples are prepared by
+    four persistent workers that are not respawned every epoch, each keeping two
+    batches in flight; prefetching more batches than that rarely helps.
+    """
+    num_workers = 4 if augment else 0
+    return DataLoader(
+        dataset,
+        batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        pin_memory=torch.cuda.is_available(),
+        # prefetch_factor may only be set when using worker processes
+        prefetch_factor=2 if num_workers > 0 else None,
+    )
+
+
+def _compute_affinities_numpy(seg: np.ndarray, nhood: np.ndarray):
     shape = seg.shape
     n_edges = nhood.shape[0]
-    dims = nhood.shape[1]
-    affinity = np.zeros((n_edges,) + shape, dtype=np.int32)
+    affinity = np.zeros((n_edges,) + shape, dtype=np.uint8)
+
+    # scratch buffer reused for every edge, sliced down to the edge's overlap
+    tmp_bool = np.empty(shape, dtype=bool)
+    # foreground mask, computed once and sliced for every edge
+    mask = seg > 0
+
+    # plain python ints, so the slice bounds below avoid numpy scalar indexing
+    offsets = nhood.tolist()
 
     for e in range(n_edges):
-        affinity[
-            e,
-            max(0, -nhood[e, 0]) : min(shape[0], shape[0] - nhood[e, 0]),
-            max(0, -nhood[e, 1]) : min(shape[1], shape[1] - nhood[e, 1]),
-        ] = (
-            (
-                seg[
-                    max(0, -nhood[e, 0]) : min(shape[0], shape[0] - nhood[e, 0]),
-                    max(0, -nhood[e, 1]) : min(shape[1], shape[1] - nhood[e, 1]),
-                ]
-                == seg[
-                    max(0, nhood[e, 0]) : min(shape[0], shape[0] + nhood[e, 0]),
-                    max(0, nhood[e, 1]) : min(shape[1], shape[1] + nhood[e, 1]),
-                ]
-            )
-            * (
-                seg[
-                    max(0, -nhood[e, 0]) : min(shape[0], shape[0] - nhood[e, 0]),
-                    max(0, -nhood[e, 1]) : min(shape[1], shape[1] - nhood[e, 1]),
-                ]
-                > 0
-            )
-            * (
-                seg[
-                    max(0, nhood[e, 0]) : min(shape[0], shape[0] + nhood[e, 0]),
-                    max(0, nhood[e, 1]) : min(shape[1], shape[1] + nhood[e, 1]),
-                ]
-                > 0
-            )
+        # slice bounds of the two overlapping views, computed once per edge
+        slice_a = tuple(
+            slice(max(0, -o), min(shape[d], shape[d] - o))
+            for d, o in enumerate(offsets[e])
         )
+        slice_b = tuple(
+            slice(max(0, o), min(shape[d], shape[d] + o))
+            for d, o in enumerate(offsets[e])
+        )
+        sa = seg[slice_a]
+        sb = seg[slice_b]
+        tmp = tmp_bool[tuple(slice(0, n) for n in sa.shape)]
+
+        np.equal(sa, sb, out=tmp)
+        np.logical_and(tmp, mask[slice_a], out=tmp)
+        np.logical_and(tmp, mask[slice_b], out=tmp)
+        np.copyto(affinity[(e,) + slice_a], tmp, casting="unsafe")
 
     return affinity
 
 
-def evaluate(gt_labels: np.ndarray, pred_labels: np.ndarray, th: float = 0.5):
-    """Function to evaluate a segmentation."""
+if numba is not None:
 
-    pred_labels_rel, _, _ = relabel_sequential(pred_labels)
-    gt_labels_rel, _, _ = relabel_sequential(gt_labels)
+    @numba.njit(cache=True, boundscheck=False)
+    def _compute_affinities_kernel(seg, nhood, out):
+        height, width = seg.shape
+        for e in range(nhood.shape[0]):
+            dy = nhood[e, 0]
+            dx = nhood[e, 1]
+            for y in range(max(0, -dy), min(height, height - dy)):
+                for x in range(max(0, -dx), min(width, width - dx)):
+                    a = seg[y, x]
+                    b = seg[y + dy, x + dx]
+                    out[e, y, x] = (a == b) & (a > 0) & (b > 0)
 
-    overlay = np.array([pred_labels_rel.flatten(), gt_labels_rel.flatten()])
 
-    # get overlaying cells and the size of the overlap
-    overlay_labels, overlay_labels_counts = np.unique(
-        overlay, return_counts=True, axis=1
-    )
-    overlay_labels = np.transpose(overlay_labels)
+def compute_affinities(seg: np.ndarray, nhood: list):
+    nhood = np.array(nhood)
+    assert nhood.ndim == 2 and nhood.shape[1] == seg.ndim, (nhood.shape, seg.shape)
 
-    # get gt cell ids and the size of the corresponding cell
-    gt_labels_list, gt_counts = np.unique(gt_labels_rel, return_counts=True)
-    gt_labels_count_dict = {}
+    if numba is None or seg.ndim != 2:
+        return _compute_affinities_numpy(seg, nhood)
+
+    affinity = np.zeros((nhood.shape[0],) + seg.shape, dtype=np.uint8)
+    _compute_affinities_kernel(seg, nhood.astype(np.int64), affinity)
+    return affinity
 
-    for l, c in zip(gt_labels_list, gt_counts):
-        gt_labels_count_dict[l] = c
 
-    # get pred cell ids
-    pred_labels_list, pred_counts = np.unique(pred_labels_rel, return_counts=True)
+def evaluate(gt_labels: np.ndarray, pred_labels: np.ndarray, th: float = 0.5):
+    """Function to evaluate a segmentation."""
 
-    pred_labels_count_dict = {}
-    for l, c in zip(pred_labels_list, pred_counts):
-        pred_labels_count_dict[l] = c
+    pred_labels_rel, _, _ = relabel_sequential(pred_labels)
+    gt_labels_rel, _, _ = relabel_sequential(gt_labels)
 
     num_pred_labels = int(np.max(pred_labels_rel))
     num_gt_labels = int(np.max(gt_labels_rel))
     num_matches = min(num_gt_labels, num_pred_labels)
 
-    # create iou table
+    # get overlaying cells and the size of the overlap: encode each
+    # (gt, pred) label pair as a single index and count all pairs in one pass
+    pred_flat = pred_labels_rel.ravel().astype(np.int64)
+    gt_flat = gt_labels_rel.ravel().astype(np.int64)
+    num_pred_bins = num_pred_labels + 1
+    pair_counts = np.bincount(gt_flat * num_pred_bins + pred_flat)
+    overlay_pairs = np.flatnonzero(pair_counts)
+    overlay_labels_counts = pair_counts[overlay_pairs]
+    overlay_gt, overlay_pred = np.divmod(overlay_pairs, num_pred_bins)
+
+    # get the size of each gt and pred cell
+    gt_counts = np.bincount(gt_flat, minlength=num_gt_labels + 1)
+    pred_counts = np.bincount(pred_flat, minlength=num_pred_labels + 1)
+
+    # create iou table, only the overlapping pairs can have a non-zero iou
     iouMat = np.zeros((num_gt_labels + 1, num_pred_labels + 1), dtype=np.float32)
-
-    for (u, v), c in zip(overlay_labels, overlay_labels_counts):
-        iou = c / (gt_labels_count_dict[v] + pred_labels_count_dict[u] - c)
-        iouMat[int(v), int(u)] = iou
+    iouMat[overlay_gt, overlay_pred] = overlay_labels_counts / (
+        gt_counts[overlay_gt] + pred_counts[overlay_pred] - overlay_labels_counts
+    )
 
     # remove background
     iouMat = iouMat[1:, 1:]
 
     # use IoU threshold th
     if num_matches > 0 and np.max(iouMat) > th:
-        costs = -(iouMat > th).astype(float) - iouMat / (2 * num_matches)
-        gt_ind, pred_ind = linear_sum_assignment(costs)
-        assert num_matches == len(gt_ind) == len(pred_ind)
+        # only cells with at least one match above the threshold can be true
+        # positives, so solve the assignment on those rows and columns only
+        above_th = iouMat > th
+        gt_cand = np.flatnonzero(above_th.any(axis=1))
+        pred_cand = np.flatnonzero(above_th.any(axis=0))
+        iou_cand = iouMat[np.ix_(gt_cand, pred_cand)]
+        costs = -(iou_cand > th).astype(float) - iou_cand / (2 * num_matches)
+        gt_ind_sub, pred_ind_sub = linear_sum_assignment(costs)
+        assert len(gt_ind_sub) == len(pred_ind_sub) <= num_matches
+        gt_ind, pred_ind = gt_cand[gt_ind_sub], pred_cand[pred_ind_sub]
         match_ok = iouMat[gt_ind, pred_ind] > th
         tp = np.count_nonzero(match_ok)
     else: